@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from agents.basic_agent import BasicAgent
 from utils.azure_file_storage import AzureFileStorageManager
 
@@ -40,24 +41,52 @@ class ContextMemoryAgent(BasicAgent):
         max_messages = kwargs.get('max_messages', 10)  # Default to 10 messages
         keywords = kwargs.get('keywords', [])
         full_recall = kwargs.get('full_recall', False)  # New parameter with default False
+        include_shared = kwargs.get('include_shared', False)
         
         # Default to full recall if no specific parameters were passed
         # This ensures initial memory loads return everything
         if 'max_messages' not in kwargs and 'keywords' not in kwargs:
             full_recall = True
         
+        # Recall shared and user memories together for callers that need both
+        if include_shared:
+            return self._recall_shared_and_user_context(user_guid, max_messages, keywords, full_recall)
+        
         # Set memory context to the user's GUID if provided
         self.storage_manager.set_memory_context(user_guid)
             
         return self._recall_context(max_messages, keywords, full_recall)
 
-    def _recall_context(self, max_messages, keywords, full_recall=False):
-        # Read from memory storage
-        memory_data = self.storage_manager.read_json()
+    def _recall_shared_and_user_context(self, user_guid, max_messages, keywords, full_recall=False):
+        """
+        Recall shared and user-specific memories in one call.
+        
+        The shared memory file is read in the background while the user context
+        is being set up and read, so both reads overlap.
+        
+        Returns:
+            dict: {'shared': str, 'user': str}
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            shared_future = executor.submit(self.storage_manager.read_shared_json)
+            self.storage_manager.set_memory_context(user_guid)
+            user_result = self._recall_context(max_messages, keywords, full_recall)
+            shared_data = shared_future.result()
+        
+        # Label the shared memories explicitly; the manager's user context is left untouched
+        shared_result = self._recall_context(max_messages, keywords, full_recall, memory_data=shared_data, memory_guid=None)
+        
+        return {'shared': shared_result, 'user': user_result}
+
+    def _recall_context(self, max_messages, keywords, full_recall=False, memory_data=None, memory_guid=None):
+        # Read from memory storage unless the caller already has the data (and its GUID)
+        if memory_data is None:
+            memory_data = self.storage_manager.read_json()
+            memory_guid = self.storage_manager.current_guid
         
         if not memory_data:
-            if self.storage_manager.current_guid:
-                return f"I don't have any memories stored yet for user ID {self.storage_manager.current_guid}."
+            if memory_guid:
+                return f"I don't have any memories stored yet for user ID {memory_guid}."
             else:
                 return "I don't have any memories stored in the shared memory yet."
                 
@@ -73,10 +102,10 @@ class ContextMemoryAgent(BasicAgent):
         if not legacy_memories:
             return "No memories found for this session."
             
-        return self._format_legacy_memories(legacy_memories, max_messages, keywords, full_recall)
+        return self._format_legacy_memories(legacy_memories, max_messages, keywords, full_recall, memory_guid)
 
-    def _format_legacy_memories(self, memories, max_messages, keywords, full_recall=False):
-        """Format memories from legacy storage format (UUIDs as keys)"""
+    def _format_legacy_memories(self, memories, max_messages, keywords, full_recall=False, memory_guid=None):
+        """Format memories from legacy storage format (UUIDs as keys); memory_guid of None means shared memory"""
         if not memories:
             return "No memories found in the format I understand."
             
@@ -103,7 +132,7 @@ class ContextMemoryAgent(BasicAgent):
             if not memory_lines:
                 return "No memories found."
                 
-            memory_source = f"for user ID {self.storage_manager.current_guid}" if self.storage_manager.current_guid else "from shared memory"
+            memory_source = f"for user ID {memory_guid}" if memory_guid else "from shared memory"
             return f"All memories {memory_source}:\n" + "\n".join(memory_lines)
             
         # Filter by keywords if provided
@@ -151,7 +180,7 @@ class ContextMemoryAgent(BasicAgent):
         if not memory_lines:
             return "No matching memories found."
             
-        memory_source = f"for user ID {self.storage_manager.current_guid}" if self.storage_manager.current_guid else "from shared memory"
+        memory_source = f"for user ID {memory_guid}" if memory_guid else "from shared memory"
         return f"Here's what I remember {memory_source}:\n" + "\n".join(memory_lines)
     
     def _summarize_memory_item(self, item):
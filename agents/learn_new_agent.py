@@ -1,43 +1,52 @@
-import os
 import logging
+import re
+import threading
 from agents.basic_agent import BasicAgent
-from azure.storage.file import FileService
+from utils.azure_file_storage import get_env, get_storage_account, get_file_service
+from utils.agents_cache import invalidate_agents_cache
+
+# Anything that is not a letter or digit is stripped from new agent names
+_NON_ALNUM_RE = re.compile(r'[\W_]+')
 
 class AzureFileStorageManager:
+    # (account, share) pairs whose agents directory has already been provisioned in this process
+    _initialized_shares = set()
+    _initialized_shares_lock = threading.Lock()
+
     def __init__(self):
-        storage_connection = os.environ.get('AzureWebJobsStorage', '')
-        if not storage_connection:
-            raise ValueError("AzureWebJobsStorage connection string is required")
-        
-        connection_parts = dict(part.split('=', 1) for part in storage_connection.split(';'))
-        
-        self.account_name = connection_parts.get('AccountName')
-        self.account_key = connection_parts.get('AccountKey')
-        self.share_name = os.environ.get('AZURE_FILES_SHARE_NAME', 'azfbusinessbot3c92ab')
+        self.account_name, self.account_key = get_storage_account()
+        self.share_name = get_env('AZURE_FILES_SHARE_NAME', 'azfbusinessbot3c92ab')
         
         if not all([self.account_name, self.account_key]):
             raise ValueError("Invalid storage connection string")
         
-        self.file_service = FileService(
-            account_name=self.account_name,
-            account_key=self.account_key
-        )
+        # Shares the memory manager's client and its sized connection pool
+        self.file_service = get_file_service(self.account_name, self.account_key)
         self._initialize_storage()
 
     def _initialize_storage(self):
-        try:
-            self.file_service.create_share(self.share_name, fail_on_exist=True)
-        except:
-            pass
+        share_key = (self.account_name, self.share_name)
+        with AzureFileStorageManager._initialized_shares_lock:
+            if share_key in AzureFileStorageManager._initialized_shares:
+                return
+            # A failed attempt is retried by the next manager instead of being remembered
+            if self._provision_agents_directory():
+                AzureFileStorageManager._initialized_shares.add(share_key)
 
+    def _provision_agents_directory(self):
+        """Create the share and agents directory, returning True once both exist"""
         try:
+            # fail_on_exist=False reports an existing share or directory as success
+            self.file_service.create_share(self.share_name, fail_on_exist=False)
             self.file_service.create_directory(
                 self.share_name,
                 'agents',
-                fail_on_exist=True
+                fail_on_exist=False
             )
+            return True
         except Exception as e:
             logging.error(f"Error creating agents directory: {str(e)}")
+            return False
 
     def write_agent_file(self, agent_name, content):
         try:
@@ -126,12 +135,14 @@ class LearnNewAgentAgent(BasicAgent):
             return "Error: Both agent_name and python_implementation are required"
 
         # Sanitize agent name
-        agent_name = ''.join(c for c in agent_name if c.isalnum())
+        agent_name = _NON_ALNUM_RE.sub('', agent_name)
         
         # Write the agent file to Azure File Storage
         success = self.storage_manager.write_agent_file(agent_name, python_implementation)
         
         if success:
+            # Make the new agent visible on the next request
+            invalidate_agents_cache()
             return f"Successfully created new agent: {agent_name}"
         else:
             return f"Failed to create agent: {agent_name}"
\ No newline at end of file
@@ -1,29 +1,95 @@
 import azure.functions as func
 import logging
-import json
 import os
 import importlib
-import importlib.util
 import inspect
 import sys
+import hashlib
+import types
 import re
 from agents.basic_agent import BasicAgent
 import uuid
-from openai import AzureOpenAI
-from datetime import datetime
 import time
-from utils.azure_file_storage import AzureFileStorageManager, safe_json_loads
+from concurrent.futures import ThreadPoolExecutor
+from utils.azure_file_storage import AzureFileStorageManager, safe_json_loads, json_dumps, json_loads, get_env, get_max_concurrency
+from utils.agents_cache import get_cached_agents, cache_agents
 
 # Default GUID to use when no specific user GUID is provided
 # Memorable pattern related to "copilot" that follows UUID format rules
 DEFAULT_USER_GUID = "c0p110t0-aaaa-bbbb-cccc-123456789abc"
 
+# GUID patterns used on every request; a GUID is always 36 characters so the
+# length is checked before running the full pattern
+_GUID_RE = re.compile(r'\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
+_LABELED_GUID_RE = re.compile(r'\A(?i:guid)[:=\s]+([0-9a-fA-F-]{36})\Z')
+
+# Remote agent files are downloaded in parallel (bounded by AZURE_FILES_MAX_CONCURRENCY,
+# which also sizes the storage connection pool), and files whose source hash has
+# not changed since the last load reuse their previously built agents
+_AGENT_FILE_HASHES = {}
+_REMOTE_AGENTS = {}
+
+# Modules in agents/ that never define loadable agents
+_EXCLUDED_AGENT_FILES = {"__init__.py", "basic_agent.py"}
+
+# System prompt skeleton; Assistant renders it once per change in memories
+_SYSTEM_PROMPT_TEMPLATE = """
+<identity>
+You are a Microsoft Copilot assistant named {assistant_name}, operating within Microsoft Teams.
+</identity>
+
+<shared_memory_output>
+These are memories accessible by all users of the system:
+{shared_memory}
+</shared_memory_output>
+
+<specific_memory_output>
+These are memories specific to the current conversation:
+{user_memory}
+</specific_memory_output>
+
+<context_instructions>
+- <shared_memory_output> represents common knowledge shared across all conversations
+- <specific_memory_output> represents specific context for the current conversation
+- Apply specific context with higher precedence than shared context
+- Synthesize information from both contexts for comprehensive responses
+</context_instructions>
+
+<agent_usage>
+IMPORTANT: You must be honest and accurate about agent usage:
+- NEVER pretend or imply you've executed an agent when you haven't actually called it
+- NEVER say "using my agent" unless you are actually making a function call to that agent
+- NEVER fabricate success messages about data operations that haven't occurred
+- If you need to perform an action and don't have the necessary agent, say so directly
+- When a user requests an action, either:
+  1. Call the appropriate agent and report actual results, or
+  2. Say "I don't have the capability to do that" and suggest an alternative
+  3. If no details are provided besides the request to run an agent, infer the necessary input parameters by "reading between the lines" of the conversation context so far
+</agent_usage>
+
+<formatting>
+Format your responses using rich formatting that works well in Teams:
+- Use **bold** for emphasis
+- Use `code blocks` for technical content
+- Apply --- for horizontal rules to separate sections
+- Utilize > for important quotes or callouts
+- Format code with ```language syntax highlighting
+- Create numbered lists with proper indentation
+- Add personality when appropriate
+- Apply # ## ### headings for clear structure
+</formatting>
+"""
+
 def ensure_string_content(message):
     """
     Ensures message content is converted to a string regardless of input type.
     """
     if not isinstance(message, dict):
         return {"role": "user", "content": str(message)}
+
+    # Already well-formed messages are passed through without copying
+    if isinstance(message.get('content'), str):
+        return message
         
     message = message.copy()
     if 'content' not in message:
@@ -42,7 +108,7 @@ def ensure_string_function_args(function_call):
         return None
         
     if isinstance(function_call.arguments, (dict, list)):
-        return json.dumps(function_call.arguments)
+        return json_dumps(function_call.arguments)
     return str(function_call.arguments)
 
 def build_cors_response(origin):
@@ -52,12 +118,18 @@ def build_cors_response(origin):
         "Access-Control-Allow-Headers": "*",
         "Access-Control-Allow-Credentials": "true",
         "Access-Control-Max-Age": "86400",
+        # The allowed origin is echoed back, so caches must key on it
+        "Vary": "Origin",
     }
 
 def load_agents_from_folder():
+    cached_agents = get_cached_agents()
+    if cached_agents is not None:
+        return cached_agents
+
     agents_directory = os.path.join(os.path.dirname(__file__), "agents")
-    files_in_agents_directory = os.listdir(agents_directory)
-    agent_files = [f for f in files_in_agents_directory if f.endswith(".py") and f not in ["__init__.py", "basic_agent.py"]]
+    with os.scandir(agents_directory) as entries:
+        agent_files = [e.name for e in entries if e.is_file() and e.name.endswith(".py") and e.name not in _EXCLUDED_AGENT_FILES]
 
     declared_agents = {}
     for file in agent_files:
@@ -74,40 +146,48 @@ def load_agents_from_folder():
 
     storage_manager = AzureFileStorageManager()
     try:
-        agent_files = storage_manager.list_files('agents')
-        
-        for file in agent_files:
-            if not file.name.endswith('_agent.py'):
-                continue
-
+        remote_files = [f for f in storage_manager.list_files('agents') if f.name.endswith('_agent.py')]
+
+        # Download the files concurrently instead of one round-trip at a time
+        file_contents = []
+        if remote_files:
+            with ThreadPoolExecutor(max_workers=get_max_concurrency()) as executor:
+                file_contents = list(executor.map(
+                    storage_manager.read_file,
+                    ['agents'] * len(remote_files),
+                    [file.name for file in remote_files]
+                ))
+
+        for file, file_content in zip(remote_files, file_contents):
             try:
-                file_content = storage_manager.read_file('agents', file.name)
                 if file_content is None:
                     continue
 
-                temp_dir = "/tmp/agents"
-                os.makedirs(temp_dir, exist_ok=True)
-                temp_file = f"{temp_dir}/{file.name}"
-
-                with open(temp_file, 'w') as f:
-                    f.write(file_content)
-
-                if temp_dir not in sys.path:
-                    sys.path.append(temp_dir)
+                # Unchanged source reuses the agents built from it last time
+                source_hash = hashlib.sha256(file_content.encode('utf-8')).hexdigest()
+                if _AGENT_FILE_HASHES.get(file.name) == source_hash and file.name in _REMOTE_AGENTS:
+                    declared_agents.update(_REMOTE_AGENTS[file.name])
+                    continue
 
+                # Compile the downloaded source straight into a fresh module
                 module_name = file.name[:-3]
-                spec = importlib.util.spec_from_file_location(module_name, temp_file)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
+                module = types.ModuleType(module_name)
+                module.__file__ = f"<azure:{file.name}>"
+                code = compile(file_content, module.__file__, 'exec')
+                exec(code, module.__dict__)
+                sys.modules[module_name] = module
 
+                file_agents = {}
                 for name, obj in inspect.getmembers(module):
                     if (inspect.isclass(obj) and
                         issubclass(obj, BasicAgent) and
                         obj is not BasicAgent):
                         agent_instance = obj()
-                        declared_agents[agent_instance.name] = agent_instance
+                        file_agents[agent_instance.name] = agent_instance
+                declared_agents.update(file_agents)
 
-                os.remove(temp_file)
+                _AGENT_FILE_HASHES[file.name] = source_hash
+                _REMOTE_AGENTS[file.name] = file_agents
 
             except Exception as e:
                 logging.error(f"Error loading agent {file.name} from Azure File Share: {str(e)}")
@@ -116,6 +196,7 @@ def load_agents_from_folder():
     except Exception as e:
         logging.error(f"Error loading agents from Azure File Share: {str(e)}")
 
+    cache_agents(declared_agents)
     return declared_agents
 
 class Assistant:
@@ -127,43 +208,65 @@ class Assistant:
             cls._instance = super(Assistant, cls).__new__(cls)
         return cls._instance
         
-    def __init__(self, declared_agents):
+    def __init__(self, initial_user_guid=DEFAULT_USER_GUID):
         # Only initialize once
         if Assistant._is_initialized:
             return
+
+        # Imported here so cold starts serving only preflight requests skip it
+        from openai import AzureOpenAI
             
         self.config = {
-            'assistant_name': str(os.environ.get('ASSISTANT_NAME', 'BusinessInsightBot')),
-            'characteristic_description': str(os.environ.get('CHARACTERISTIC_DESCRIPTION', 'helpful business assistant'))
+            'assistant_name': str(get_env('ASSISTANT_NAME', 'BusinessInsightBot')),
+            'characteristic_description': str(get_env('CHARACTERISTIC_DESCRIPTION', 'helpful business assistant'))
         }
 
+        http_client = self._build_http_client()
+
         try:
             self.client = AzureOpenAI(
                 api_key=os.environ['AZURE_OPENAI_API_KEY'],
                 api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-                azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT']
+                azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+                http_client=http_client
             )
         except TypeError:
             self.client = AzureOpenAI(
                 api_key=os.environ['AZURE_OPENAI_API_KEY'],
-                azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT']
+                azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+                http_client=http_client
             )
 
-        self.known_agents = self.reload_agents(declared_agents)
+        self._declared_agents = load_agents_from_folder()
+        self.known_agents = self.reload_agents(self._declared_agents)
         
-        # Set the default user GUID instead of None
-        self.user_guid = DEFAULT_USER_GUID
+        # Start from the requested GUID, falling back to the default instead of None
+        self.user_guid = initial_user_guid or DEFAULT_USER_GUID
         
         self.shared_memory = None
         self.user_memory = None
+        # GUID whose memories were loaded but not yet used by a request
+        self._unused_memory_guid = None
         self.storage_manager = AzureFileStorageManager()
         
-        # Initialize with the default user GUID memory
-        self._initialize_context_memory(DEFAULT_USER_GUID)
+        # Initialize memory once for the starting GUID
+        self._initialize_context_memory(self.user_guid)
         
         Assistant._is_initialized = True
 
-    def _check_first_message_for_guid(self, conversation_history):
+    def _build_http_client(self):
+        """Build a pooled HTTP client shared by all OpenAI calls, using HTTP/2 when available"""
+        import httpx
+
+        limits = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+        try:
+            return httpx.Client(http2=True, limits=limits, timeout=60.0)
+        except ImportError:
+            # HTTP/2 needs the optional h2 package; keep the pooled HTTP/1.1 client without it
+            return httpx.Client(limits=limits, timeout=60.0)
+
+    @staticmethod
+    def _check_first_message_for_guid(conversation_history):
         """Check if the first message contains only a GUID"""
         if not conversation_history or len(conversation_history) == 0:
             return None
@@ -171,8 +274,7 @@ class Assistant:
         first_message = conversation_history[0]
         if first_message.get('role') == 'user':
             content = str(first_message.get('content', '')).strip()
-            guid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
-            if guid_pattern.match(content):
+            if len(content) == 36 and _GUID_RE.match(content):
                 return content
         return None
 
@@ -185,24 +287,36 @@ class Assistant:
                 self.user_memory = "No specific context memory available."
                 return
 
-            # Always get shared memories with full_recall=True to ensure complete context
-            self.storage_manager.set_memory_context(None)  # Reset to shared context
-            self.shared_memory = str(context_memory_agent.perform(full_recall=True))
-            
-            # If user_guid provided, get user-specific memories with full_recall=True
             # If no user_guid is provided, fall back to the default GUID
             if not user_guid:
                 user_guid = DEFAULT_USER_GUID
                 
-            self.storage_manager.set_memory_context(user_guid)
-            self.user_memory = str(context_memory_agent.perform(user_guid=user_guid, full_recall=True))
+            # Get shared and user-specific memories with full_recall=True in a single call
+            memories = context_memory_agent.perform(user_guid=user_guid, full_recall=True, include_shared=True)
+            self.shared_memory = str(memories['shared'])
+            self.user_memory = str(memories['user'])
+            self._unused_memory_guid = user_guid
             
         except Exception as e:
             logging.warning(f"Error initializing context memory: {str(e)}")
             self.shared_memory = "Context memory initialization failed."
             self.user_memory = "Context memory initialization failed."
     
-    def extract_user_guid(self, text):
+    def refresh_context_memory(self, user_guid):
+        """
+        Point the assistant at user_guid and reload its memories for this request.
+        
+        Memories change between requests (ManageMemory writes, other instances), so they
+        are reloaded every time; unchanged memory files only cost an ETag check. Memories
+        just loaded for the same GUID, e.g. by a cold start, are used as they are.
+        """
+        if self._unused_memory_guid != user_guid:
+            self.user_guid = user_guid
+            self._initialize_context_memory(user_guid)
+        self._unused_memory_guid = None
+
+    @staticmethod
+    def extract_user_guid(text):
         """Try to extract a GUID from user input, but only if it's the entire message"""
         if text is None:
             return None
@@ -210,25 +324,27 @@ class Assistant:
         text_str = str(text).strip()
         
         # Only match if the entire message is just a GUID
-        guid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
-        match = guid_pattern.match(text_str)
+        match = _GUID_RE.match(text_str) if len(text_str) == 36 else None
         if match:
             return match.group(0)
         
         # Also allow labeled GUIDs for explicit behavior
-        labeled_guid_pattern = re.compile(r'^guid[:=\s]+([0-9a-f-]{36})$', re.IGNORECASE)
-        match = labeled_guid_pattern.match(text_str)
+        match = _LABELED_GUID_RE.match(text_str)
         if match:
             return match.group(1)
                 
         return None
 
+    def maybe_refresh_agents(self):
+        """Pick up a rebuilt agent set once the load_agents_from_folder cache expires or is invalidated"""
+        declared_agents = load_agents_from_folder()
+        if declared_agents is not self._declared_agents:
+            self._declared_agents = declared_agents
+            self.known_agents = self.reload_agents(declared_agents)
+
     def get_agent_metadata(self):
-        agents_metadata = []
-        for agent in self.known_agents.values():
-            if hasattr(agent, 'metadata'):
-                agents_metadata.append(agent.metadata)
-        return agents_metadata
+        # Built once per reload_agents call rather than on every OpenAI call
+        return self._metadata_cache
 
     def reload_agents(self, agent_objects):
         known_agents = {}
@@ -244,73 +360,40 @@ class Assistant:
                     known_agents[agent.name] = agent
         else:
             logging.warning(f"Unexpected agent_objects type: {type(agent_objects)}")
+        self._metadata_cache = [agent.metadata for agent in known_agents.values() if hasattr(agent, 'metadata')]
         return known_agents
 
+    def _get_system_prompt(self):
+        """Return the system prompt, re-rendering it only when the name or memories change"""
+        key = (self.config.get('assistant_name', 'Assistant'), self.shared_memory, self.user_memory)
+        if getattr(self, '_system_prompt_key', None) != key:
+            self._system_prompt = _SYSTEM_PROMPT_TEMPLATE.format(
+                assistant_name=str(key[0]),
+                shared_memory=str(key[1]),
+                user_memory=str(key[2])
+            )
+            self._system_prompt_key = key
+        return self._system_prompt
+
     def prepare_messages(self, conversation_history):
         if not isinstance(conversation_history, list):
             conversation_history = []
             
-        messages = []
-        current_datetime = datetime.now().strftime("%A, %B %d, %Y at %I:%M %p")
-        
         # System message
         system_message = {
             "role": "system",
-            "content": f"""
-<identity>
-You are a Microsoft Copilot assistant named {str(self.config.get('assistant_name', 'Assistant'))}, operating within Microsoft Teams.
-</identity>
-
-<shared_memory_output>
-These are memories accessible by all users of the system:
-{str(self.shared_memory)}
-</shared_memory_output>
-
-<specific_memory_output>
-These are memories specific to the current conversation:
-{str(self.user_memory)}
-</specific_memory_output>
-
-<context_instructions>
-- <shared_memory_output> represents common knowledge shared across all conversations
-- <specific_memory_output> represents specific context for the current conversation
-- Apply specific context with higher precedence than shared context
-- Synthesize information from both contexts for comprehensive responses
-</context_instructions>
-
-<agent_usage>
-IMPORTANT: You must be honest and accurate about agent usage:
-- NEVER pretend or imply you've executed an agent when you haven't actually called it
-- NEVER say "using my agent" unless you are actually making a function call to that agent
-- NEVER fabricate success messages about data operations that haven't occurred
-- If you need to perform an action and don't have the necessary agent, say so directly
-- When a user requests an action, either:
-  1. Call the appropriate agent and report actual results, or
-  2. Say "I don't have the capability to do that" and suggest an alternative
-  3. If no details are provided besides the request to run an agent, infer the necessary input parameters by "reading between the lines" of the conversation context so far
-</agent_usage>
-
-<formatting>
-Format your responses using rich formatting that works well in Teams:
-- Use **bold** for emphasis
-- Use `code blocks` for technical content
-- Apply --- for horizontal rules to separate sections
-- Utilize > for important quotes or callouts
-- Format code with ```language syntax highlighting
-- Create numbered lists with proper indentation
-- Add personality when appropriate
-- Apply # ## ### headings for clear structure
-</formatting>
-"""
+            "content": self._get_system_prompt()
         }
-        messages.append(ensure_string_content(system_message))
         
         # Process conversation history - skip first message if it's just a GUID
         guid_only_first_message = self._check_first_message_for_guid(conversation_history)
         start_idx = 1 if guid_only_first_message else 0
         
-        for i in range(start_idx, len(conversation_history)):
-            messages.append(ensure_string_content(conversation_history[i]))
+        # Size the list up front so long histories don't trigger repeated regrowth
+        messages = [None] * (len(conversation_history) - start_idx + 1)
+        messages[0] = ensure_string_content(system_message)
+        for j, i in enumerate(range(start_idx, len(conversation_history)), start=1):
+            messages[j] = ensure_string_content(conversation_history[i])
             
         return messages
     
@@ -403,27 +486,31 @@ Format your responses using rich formatting that works well in Teams:
                     return f"Error parsing parameters: {str(e)}", ""
 
                 # Add the function result to messages
+                result_str = str(result)
                 messages.append({
                     "role": "function",
                     "name": agent_name,
-                    "content": str(result)
+                    "content": result_str
                 })
                 
                 # EVALUATION: Check if we need a follow-up function call
-                try:
-                    result_json = json.loads(str(result))
-                    # Look for error indicators or incomplete data flags
-                    needs_follow_up = False
-                    if isinstance(result_json, dict):
-                        # Check for error indicators
-                        if result_json.get('error') or result_json.get('status') == 'incomplete':
-                            needs_follow_up = True
-                        # Check for specific indicators that another action is needed
-                        if result_json.get('requires_additional_action') == True:
-                            needs_follow_up = True
-                except:
-                    # If we can't parse the result as JSON, assume no follow-up needed
-                    needs_follow_up = False
+                # Only JSON objects carry follow-up flags, so plain-text results
+                # skip the parser (and the exception it would raise) entirely
+                needs_follow_up = False
+                if result_str.lstrip()[:1] == '{':
+                    try:
+                        result_json = json_loads(result_str)
+                        # Look for error indicators or incomplete data flags
+                        if isinstance(result_json, dict):
+                            # Check for error indicators
+                            if result_json.get('error') or result_json.get('status') == 'incomplete':
+                                needs_follow_up = True
+                            # Check for specific indicators that another action is needed
+                            if result_json.get('requires_additional_action') == True:
+                                needs_follow_up = True
+                    except:
+                        # If we can't parse the result as JSON, assume no follow-up needed
+                        needs_follow_up = False
                 
                 # If we don't need a follow-up, get the final response and return
                 if not needs_follow_up:
@@ -452,9 +539,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     cors_headers = build_cors_response(origin)
 
     if req.method == 'OPTIONS':
+        # Answer preflight with no body and let the browser cache it for a day
         return func.HttpResponse(
-            status_code=200,
-            headers=cors_headers
+            status_code=204,
+            headers={**cors_headers, "Cache-Control": "max-age=86400"}
         )
 
     try:
@@ -485,12 +573,13 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     user_guid = req_body.get('user_guid')
     
     # Skip validation if input is just a GUID to load memory
-    is_guid_only = re.match(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', user_input.strip(), re.IGNORECASE)
+    stripped_input = user_input.strip()
+    is_guid_only = len(stripped_input) == 36 and _GUID_RE.match(stripped_input)
     
     # Validate user input for non-GUID requests
-    if not is_guid_only and not user_input.strip():
+    if not is_guid_only and not stripped_input:
         return func.HttpResponse(
-            json.dumps({
+            json_dumps({
                 "error": "Missing or empty user_input in JSON payload"
             }),
             status_code=400,
@@ -499,17 +588,18 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         )
 
     try:
-        agents = load_agents_from_folder()
-        assistant = Assistant(agents)
+        # Resolve the GUID with get_response's precedence (GUID-only first message, then a
+        # bare or "guid: <id>" input) ahead of the request body, so it never reloads again
+        target_guid = (Assistant._check_first_message_for_guid(conversation_history)
+                       or Assistant.extract_user_guid(user_input)
+                       or user_guid
+                       or DEFAULT_USER_GUID)
+
+        assistant = Assistant(initial_user_guid=target_guid)
+        assistant.maybe_refresh_agents()
         
-        # Set user_guid if provided in the request or found in input
-        if user_guid:
-            assistant.user_guid = user_guid
-            assistant._initialize_context_memory(user_guid)
-        elif is_guid_only:
-            assistant.user_guid = user_input.strip()
-            assistant._initialize_context_memory(user_input.strip())
-        # Otherwise, the default GUID will be used (already set in __init__)
+        # Memories may have changed since the last request, so always refresh them
+        assistant.refresh_context_memory(target_guid)
             
         assistant_response, agent_logs = assistant.get_response(
             user_input, conversation_history)
@@ -522,7 +612,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         }
 
         return func.HttpResponse(
-            json.dumps(response),
+            json_dumps(response),
             mimetype="application/json",
             headers=cors_headers
         )
@@ -532,7 +622,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             "details": str(e)
         }
         return func.HttpResponse(
-            json.dumps(error_response),
+            json_dumps(error_response),
             status_code=500,
             mimetype="application/json",
             headers=cors_headers
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("azure.common")
+
+from utils.azure_file_storage import AzureFileStorageManager
+
+
+class StubFileService:
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def list_directories_and_files(self, share_name, directory_name, num_results=None):
+        self.calls.append((share_name, directory_name, num_results))
+        return iter(self.items)
+
+
+def make_manager(items):
+    # Skip __init__ so no storage account or network access is needed
+    manager = object.__new__(AzureFileStorageManager)
+    manager.share_name = "test-share"
+    manager.file_service = StubFileService(items)
+    return manager
+
+
+def test_iter_files_stops_at_limit_and_passes_num_results():
+    manager = make_manager(["a", "b", "c", "d", "e"])
+
+    assert list(manager.iter_files("memory", limit=2)) == ["a", "b"]
+    assert manager.file_service.calls == [("test-share", "memory", 2)]
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_iter_files_non_positive_limit_skips_service(limit):
+    manager = make_manager(["a", "b"])
+
+    assert list(manager.iter_files("memory", limit=limit)) == []
+    assert manager.file_service.calls == []
+
+
+def test_iter_files_without_limit_yields_everything():
+    manager = make_manager(["a", "b", "c"])
+
+    assert list(manager.iter_files("memory")) == ["a", "b", "c"]
+    assert manager.file_service.calls == [("test-share", "memory", None)]
@@ -0,0 +1,29 @@
+import time
+
+# Loaded agents are reused across invocations until the TTL expires or a new
+# agent is written through LearnNewAgent. Kept outside function_app so agents
+# can invalidate it without importing the Functions entry point.
+_AGENTS_CACHE = {"data": None, "ts": 0.0}
+_AGENTS_TTL = 60
+
+def get_cached_agents():
+    """
+    Returns the cached agent set, or None once it has expired or been invalidated.
+    """
+    if _AGENTS_CACHE["data"] is not None and time.time() - _AGENTS_CACHE["ts"] < _AGENTS_TTL:
+        return _AGENTS_CACHE["data"]
+    return None
+
+def cache_agents(declared_agents):
+    """
+    Stores a freshly loaded agent set and restarts the TTL.
+    """
+    _AGENTS_CACHE["data"] = declared_agents
+    _AGENTS_CACHE["ts"] = time.time()
+
+def invalidate_agents_cache():
+    """
+    Forces the next load_agents_from_folder call to rebuild the agent set.
+    """
+    _AGENTS_CACHE["data"] = None
+    _AGENTS_CACHE["ts"] = 0.0
@@ -1,52 +1,214 @@
 import json
 import os
 import logging
-import re
-from azure.storage.file import FileService
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from azure.common import AzureMissingResourceHttpError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# A GUID is always 36 characters: 8-4-4-4-12 hex digits separated by dashes
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+def _is_guid(value):
+    """
+    Checks the fixed GUID layout directly instead of running a regex.
+    """
+    return (len(value) == 36
+            and value[8] == value[13] == value[18] == value[23] == '-'
+            and _HEX_DIGITS.issuperset(value.replace('-', '', 4)))
+
+# Environment values and the parsed storage connection string are resolved once
+# per process instead of on every manager construction
+_ENV_CACHE = {}
+
+def get_env(key, default=None):
+    """
+    Returns an environment variable, caching the first lookup for the process.
+    """
+    if key not in _ENV_CACHE:
+        _ENV_CACHE[key] = os.environ.get(key, default)
+    return _ENV_CACHE[key]
+
+@lru_cache(maxsize=1)
+def _parse_conn(storage_connection):
+    """
+    Extracts (account_name, account_key) from a storage connection string,
+    stopping as soon as both values have been seen.
+    """
+    account_name = None
+    account_key = None
+    rest = storage_connection
+    while rest and (account_name is None or account_key is None):
+        part, _, rest = rest.partition(';')
+        if account_name is None and part.startswith('AccountName='):
+            account_name = part[12:]
+        elif account_key is None and part.startswith('AccountKey='):
+            account_key = part[11:]
+    return account_name, account_key
+
+def get_storage_account():
+    """
+    Returns (account_name, account_key) from the AzureWebJobsStorage setting.
+    """
+    storage_connection = get_env('AzureWebJobsStorage', '')
+    if not storage_connection:
+        raise ValueError("AzureWebJobsStorage connection string is required")
+    return _parse_conn(storage_connection)
+
+def json_dumps(data):
+    """
+    Serializes data to compact JSON, using orjson when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data).decode('utf-8')
+        except TypeError:
+            # orjson rejects some inputs the stdlib accepts (e.g. non-str keys)
+            pass
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+def json_loads(json_str):
+    """
+    Parses a JSON string or bytes, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+def get_max_concurrency():
+    """
+    Number of concurrent storage requests, configurable to avoid overwhelming the account.
+    """
+    try:
+        return max(1, int(get_env('AZURE_FILES_MAX_CONCURRENCY', '16')))
+    except ValueError:
+        return 16
+
+# FileService clients shared by every storage manager using the same account
+_FILE_SERVICES = {}
+
+def get_file_service(account_name, account_key):
+    """
+    Returns the process-wide FileService for an account, creating it on first use.
+    """
+    service_key = (account_name, account_key)
+    if service_key not in _FILE_SERVICES:
+        # Imported on first use to keep the SDK off the module import path
+        import requests
+        from azure.storage.file import FileService
+
+        # Size the keep-alive pool for concurrent deletes/downloads so parallel
+        # requests reuse connections instead of opening and dropping extra ones
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=get_max_concurrency())
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _FILE_SERVICES[service_key] = FileService(
+            account_name=account_name,
+            account_key=account_key,
+            request_session=session
+        )
+    return _FILE_SERVICES[service_key]
 
 def safe_json_loads(json_str):
     """
-    Safely loads JSON string, handling potential errors.
+    Safely loads a JSON string or UTF-8 bytes, handling potential errors.
     """
-    if not json_str:
+    # Empty and freshly created memory files ('{}') never need the parser
+    if not json_str or json_str == '{}' or json_str == b'{}':
         return {}
     try:
         if isinstance(json_str, (dict, list)):
             return json_str
-        return json.loads(json_str)
-    except json.JSONDecodeError:
+        return json_loads(json_str)
+    except (json.JSONDecodeError, UnicodeDecodeError):
         return {"error": f"Invalid JSON: {json_str}"}
 
 class AzureFileStorageManager:
+    # (account, share) pairs whose share and shared memory file are provisioned
+    _shares_ready = set()
+    _shares_lock = threading.Lock()
+    # Existence checks and cached memory files per (account, share), shared by every
+    # manager so agents rebuilt on each agent reload don't start with cold caches
+    _share_caches = {}
+
     def __init__(self):
-        storage_connection = os.environ.get('AzureWebJobsStorage', '')
-        if not storage_connection:
-            raise ValueError("AzureWebJobsStorage connection string is required")
-        
-        connection_parts = dict(part.split('=', 1) for part in storage_connection.split(';'))
-        
-        self.account_name = connection_parts.get('AccountName')
-        self.account_key = connection_parts.get('AccountKey')
-        self.share_name = os.environ.get('AZURE_FILES_SHARE_NAME', 'azfbusinessbot3c92ab')
+        self.account_name, self.account_key = get_storage_account()
+        self.share_name = get_env('AZURE_FILES_SHARE_NAME', 'azfbusinessbot3c92ab')
         self.shared_memory_path = "shared_memories"  # Default shared memories path
         self.default_file_name = 'memory.json'
         self.current_guid = None
         self.current_memory_path = self.shared_memory_path  # Initialize to shared memory path
         
         # List of accepted default GUIDs that bypass validation
-        self.default_guids = [
+        self.default_guids = frozenset([
             "c0p110t0-aaaa-bbbb-cccc-123456789abc",  # Original default from function_app.py
             "d3fau1t0-c0p1-10t0-b0t0-111111111111"   # Additional default seen in logs
-        ]
+        ])
+        
+        share_cache = AzureFileStorageManager._share_caches.setdefault(
+            (self.account_name, self.share_name),
+            {"dirs": set(), "files": set(), "guids": set(), "json": {}}
+        )
+        # Directories and files already confirmed to exist in this process
+        self._verified_dirs = share_cache["dirs"]
+        self._verified_files = share_cache["files"]
+        # GUIDs whose memory directory and file are set up; set_memory_context skips them
+        self._provisioned_guids = share_cache["guids"]
+        # Raw JSON content of memory files keyed by (share, directory, file), stored with its ETag
+        self._json_cache = share_cache["json"]
         
         if not all([self.account_name, self.account_key]):
             raise ValueError("Invalid storage connection string")
         
-        self.file_service = FileService(
-            account_name=self.account_name,
-            account_key=self.account_key
-        )
-        self._ensure_share_exists()
+        self.file_service = get_file_service(self.account_name, self.account_key)
+        with AzureFileStorageManager._shares_lock:
+            if (self.account_name, self.share_name) not in AzureFileStorageManager._shares_ready:
+                self._ensure_share_exists()
+
+    def _forget_verified_paths(self):
+        """Drop cached existence checks after the service reports a missing resource"""
+        AzureFileStorageManager._shares_ready.discard((self.account_name, self.share_name))
+        self._verified_dirs.clear()
+        self._verified_files.clear()
+        self._provisioned_guids.clear()
+
+    def _ensure_json_file(self, directory_name, file_name):
+        """
+        Create an empty JSON file unless it is already known to exist.
+        
+        Files seen or created once in this process are not probed again.
+        
+        Returns:
+            bool: True if the file was created, False if it already existed.
+        """
+        file_key = (directory_name, file_name)
+        if file_key in self._verified_files:
+            return False
+        
+        try:
+            self.file_service.get_file_properties(
+                self.share_name,
+                directory_name,
+                file_name
+            )
+            created = False
+        except Exception:
+            self.ensure_directory_exists(directory_name)
+            self.file_service.create_file_from_text(
+                self.share_name,
+                directory_name,
+                file_name,
+                '{}'  # Empty JSON object
+            )
+            created = True
+        self._verified_files.add(file_key)
+        return created
 
     def _ensure_share_exists(self):
         try:
@@ -54,20 +216,9 @@ class AzureFileStorageManager:
             
             # Only ensure shared memories directory and file exist
             self.ensure_directory_exists(self.shared_memory_path)
-            try:
-                self.file_service.get_file_properties(
-                    self.share_name,
-                    self.shared_memory_path,
-                    self.default_file_name
-                )
-            except Exception:
-                self.file_service.create_file_from_text(
-                    self.share_name,
-                    self.shared_memory_path,
-                    self.default_file_name,
-                    '{}'  # Empty JSON object
-                )
+            if self._ensure_json_file(self.shared_memory_path, self.default_file_name):
                 logging.info(f"Created new {self.default_file_name} in shared memories directory")
+            AzureFileStorageManager._shares_ready.add((self.account_name, self.share_name))
         except Exception as e:
             logging.error(f"Error ensuring share exists: {str(e)}")
             raise
@@ -79,31 +230,23 @@ class AzureFileStorageManager:
             self.current_memory_path = self.shared_memory_path
             return True
         
+        # GUIDs already set up in this process need no validation or storage checks
+        if guid in self._provisioned_guids:
+            self.current_guid = guid
+            self.current_memory_path = f"memory/{guid}"
+            return True
+        
         # Accept any default GUID without validation
         if guid in self.default_guids:
             self.current_guid = guid
             user_dir = f"memory/{guid}"
             self.current_memory_path = user_dir
             
-            # Check if directory exists, if not create it
+            # Create the directory and user memory file if they don't exist
             try:
-                self.ensure_directory_exists(user_dir)
-                # Check if the user memory file exists
-                try:
-                    self.file_service.get_file_properties(
-                        self.share_name,
-                        user_dir,
-                        "user_memory.json"
-                    )
-                except Exception:
-                    # Create the file if it doesn't exist
-                    self.file_service.create_file_from_text(
-                        self.share_name,
-                        user_dir,
-                        "user_memory.json",
-                        '{}'  # Empty JSON object
-                    )
+                if self._ensure_json_file(user_dir, "user_memory.json"):
                     logging.info(f"Created new memory file for default GUID: {guid}")
+                self._provisioned_guids.add(guid)
                 return True
             except Exception as e:
                 logging.error(f"Error setting up default GUID memory: {str(e)}")
@@ -112,8 +255,7 @@ class AzureFileStorageManager:
                 return False
         
         # For other GUIDs, validate the format
-        guid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
-        if not guid_pattern.match(guid):
+        if not _is_guid(guid):
             logging.warning(f"Invalid GUID format: {guid}. Using shared memory.")
             self.current_guid = None
             self.current_memory_path = self.shared_memory_path
@@ -124,30 +266,13 @@ class AzureFileStorageManager:
             guid_dir = f"memory/{guid}"
             guid_file = "user_memory.json"
             
-            # Check if GUID directory already exists before creating
-            try:
-                self.file_service.get_file_properties(
-                    self.share_name,
-                    guid_dir,
-                    guid_file
-                )
-                # If we get here, the file exists
-                self.current_guid = guid
-                self.current_memory_path = guid_dir
-                return True
-            except Exception:
-                # Create new GUID directory and file
-                self.ensure_directory_exists(guid_dir)
-                self.file_service.create_file_from_text(
-                    self.share_name,
-                    guid_dir,
-                    guid_file,
-                    '{}'  # Empty JSON object
-                )
+            # Create new GUID directory and file only if they don't exist yet
+            if self._ensure_json_file(guid_dir, guid_file):
                 logging.info(f"Created new memory file for GUID: {guid}")
-                self.current_guid = guid
-                self.current_memory_path = guid_dir
-                return True
+            self.current_guid = guid
+            self.current_memory_path = guid_dir
+            self._provisioned_guids.add(guid)
+            return True
             
         except Exception as e:
             logging.error(f"Error setting memory context for GUID {guid}: {str(e)}")
@@ -202,8 +327,7 @@ class AzureFileStorageManager:
                     return False, f"Error clearing memory for default GUID '{guid}': {str(e)}"
             
             # For other GUIDs, validate the format
-            guid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
-            if not guid_pattern.match(guid):
+            if not _is_guid(guid):
                 return False, f"Invalid GUID format: {guid}. Cannot clear memory."
             
             # Handle regular GUIDs
@@ -245,69 +369,124 @@ class AzureFileStorageManager:
         else:
             return self._read_shared_memory()
 
-    def _read_shared_memory(self):
-        try:
-            file_content = self.file_service.get_file_to_text(
+    def read_shared_json(self):
+        """Read the shared memories without changing the current memory context"""
+        return self._read_shared_memory()
+
+    def _read_cached_json(self, directory_name, file_name):
+        """
+        Read a JSON file, downloading it only when its ETag differs from the cached copy.
+        
+        The cached content is parsed on every call so callers always get their own dict.
+        """
+        cache_key = (self.share_name, directory_name, file_name)
+        cached = self._json_cache.get(cache_key)
+        if cached:
+            properties = self.file_service.get_file_properties(
                 self.share_name,
-                self.shared_memory_path,
-                self.default_file_name
+                directory_name,
+                file_name
             )
-            return safe_json_loads(file_content.content)
+            if properties.properties.etag == cached[0]:
+                return safe_json_loads(cached[1])
+
+        # Raw bytes go straight to the parser without an intermediate str decode
+        file_content = self.file_service.get_file_to_bytes(
+            self.share_name,
+            directory_name,
+            file_name
+        )
+        etag = file_content.properties.etag
+        if etag:
+            self._json_cache[cache_key] = (etag, file_content.content)
+        return safe_json_loads(file_content.content)
+
+    def _invalidate_cached_json(self, directory_name, file_name):
+        self._json_cache.pop((self.share_name, directory_name, file_name), None)
+
+    def _read_shared_memory(self):
+        try:
+            return self._read_cached_json(self.shared_memory_path, self.default_file_name)
+        except AzureMissingResourceHttpError as e:
+            logging.error(f"Error reading from shared memory: {str(e)}")
+            self._forget_verified_paths()
+            self._ensure_share_exists()
+            return {}
         except Exception as e:
             logging.error(f"Error reading from shared memory: {str(e)}")
-            if "ResourceNotFound" in str(e):
-                self._ensure_share_exists()
             return {}
 
     def _read_guid_memory(self):
         try:
-            file_content = self.file_service.get_file_to_text(
-                self.share_name,
-                self.current_memory_path,
-                "user_memory.json"
-            )
-            return safe_json_loads(file_content.content)
+            return self._read_cached_json(self.current_memory_path, "user_memory.json")
+        except AzureMissingResourceHttpError as e:
+            # The file vanished after this GUID was provisioned; recreate it rather than
+            # letting read_json fall back and route the user's writes to shared memory
+            logging.warning(f"GUID memory missing, recreating: {str(e)}")
+            self._verified_files.discard((self.current_memory_path, "user_memory.json"))
+            self._invalidate_cached_json(self.current_memory_path, "user_memory.json")
+            self._verified_dirs.discard(self.current_memory_path)
+            try:
+                self._ensure_json_file(self.current_memory_path, "user_memory.json")
+            except Exception as create_error:
+                # Stay on the GUID path; _write_guid_memory re-provisions on its own retry
+                logging.error(f"Error recreating GUID memory: {str(create_error)}")
+                self._provisioned_guids.discard(self.current_guid)
+            return {}
         except Exception as e:
             logging.error(f"Error reading from GUID memory: {str(e)}")
             raise  # Let read_json handle the fallback
 
     def write_json(self, data):
         """Write to either GUID-specific memory or shared memories"""
+        # Serialize once; the shared-memory fallback reuses the same payload
+        payload = json_dumps(data)
         if self.current_guid and self.current_memory_path != self.shared_memory_path:
             try:
-                self._write_guid_memory(data)
+                self._write_guid_memory(payload)
             except Exception:
                 # Fall back to shared memory on any error
                 self.current_guid = None
                 self.current_memory_path = self.shared_memory_path
-                self._write_shared_memory(data)
+                self._write_shared_memory(payload)
         else:
-            self._write_shared_memory(data)
+            self._write_shared_memory(payload)
+
+    def _upload(self, directory_name, file_name, payload):
+        """Upload pre-serialized JSON, dropping any cached copy of the file first"""
+        self._invalidate_cached_json(directory_name, file_name)
+        self.file_service.create_file_from_text(
+            self.share_name,
+            directory_name,
+            file_name,
+            payload
+        )
 
-    def _write_shared_memory(self, data):
+    def _write_shared_memory(self, payload, retry=True):
         try:
-            json_content = json.dumps(data, indent=4)
-            self.file_service.create_file_from_text(
-                self.share_name,
-                self.shared_memory_path,
-                self.default_file_name,
-                json_content
-            )
-        except Exception as e:
+            self._upload(self.shared_memory_path, self.default_file_name, payload)
+        except AzureMissingResourceHttpError as e:
             logging.error(f"Error writing to shared memory: {str(e)}")
-            if "ResourceNotFound" in str(e):
+            if retry:
+                # Cached directory checks are stale; recreate and retry once
+                self._forget_verified_paths()
                 self._ensure_share_exists()
-                self._write_shared_memory(data)
+                self._write_shared_memory(payload, retry=False)
+        except Exception as e:
+            logging.error(f"Error writing to shared memory: {str(e)}")
 
-    def _write_guid_memory(self, data):
+    def _write_guid_memory(self, payload, retry=True):
         try:
-            json_content = json.dumps(data, indent=4)
-            self.file_service.create_file_from_text(
-                self.share_name,
-                self.current_memory_path,
-                "user_memory.json",
-                json_content
-            )
+            self._upload(self.current_memory_path, "user_memory.json", payload)
+        except AzureMissingResourceHttpError as e:
+            logging.error(f"Error writing to GUID memory: {str(e)}")
+            if retry:
+                # Cached directory checks are stale; recreate and retry once
+                self._forget_verified_paths()
+                self._ensure_share_exists()
+                self.ensure_directory_exists(self.current_memory_path)
+                return self._write_guid_memory(payload, retry=False)
+            raise  # Let write_json handle the fallback
         except Exception as e:
             logging.error(f"Error writing to GUID memory: {str(e)}")
             raise  # Let write_json handle the fallback
@@ -317,25 +496,28 @@ class AzureFileStorageManager:
         try:
             if not directory_name:
                 return False
-                
-            self.file_service.create_share(self.share_name, fail_on_exist=False)
-            
-            # Handle nested directories
-            parts = directory_name.split('/')
-            current_path = ""
+
+            if directory_name in self._verified_dirs:
+                return True
             
-            for part in parts:
-                if part:
-                    if current_path:
-                        current_path = f"{current_path}/{part}"
-                    else:
-                        current_path = part
-                        
-                    self.file_service.create_directory(
-                        self.share_name,
-                        current_path,
-                        fail_on_exist=False
-                    )
+            # Handle nested directories by walking each "/" boundary of the path
+            length = len(directory_name)
+            start = 0
+            while start < length:
+                end = directory_name.find('/', start)
+                if end == -1:
+                    end = length
+                if end > start:
+                    current_path = directory_name[:end]
+                    if current_path not in self._verified_dirs:
+                        self.file_service.create_directory(
+                            self.share_name,
+                            current_path,
+                            fail_on_exist=False
+                        )
+                        self._verified_dirs.add(current_path)
+                start = end + 1
+            self._verified_dirs.add(directory_name)
             return True
         except Exception as e:
             logging.error(f"Error ensuring directory exists: {str(e)}")
@@ -344,12 +526,21 @@ class AzureFileStorageManager:
     def write_file(self, directory_name, file_name, content):
         try:
             self.ensure_directory_exists(directory_name)
-            self.file_service.create_file_from_text(
-                self.share_name,
-                directory_name,
-                file_name,
-                str(content)  # Ensure content is string
-            )
+            if isinstance(content, (bytes, bytearray)):
+                # Upload binary content as-is instead of writing its repr
+                self.file_service.create_file_from_bytes(
+                    self.share_name,
+                    directory_name,
+                    file_name,
+                    bytes(content)
+                )
+            else:
+                self.file_service.create_file_from_text(
+                    self.share_name,
+                    directory_name,
+                    file_name,
+                    content if isinstance(content, str) else str(content)  # Ensure content is string
+                )
             return True
         except Exception as e:
             logging.error(f"Error writing file: {str(e)}")
@@ -377,6 +568,30 @@ class AzureFileStorageManager:
             logging.error(f"Error listing files: {str(e)}")
             return []
             
+    def iter_files(self, directory_name, limit=None):
+        """
+        Lazily yield directory entries, stopping after `limit` items.
+        
+        Unlike list_files, no more than `limit` entries are requested from the
+        service, so existence and preview checks don't page through the whole directory.
+        """
+        # Azure rejects num_results <= 0, so there is nothing to request
+        if limit is not None and limit <= 0:
+            return
+        try:
+            items = self.file_service.list_directories_and_files(
+                self.share_name,
+                directory_name,
+                num_results=limit
+            )
+            for index, item in enumerate(items):
+                if limit is not None and index >= limit:
+                    return
+                yield item
+        except Exception as e:
+            logging.error(f"Error listing files: {str(e)}")
+            return
+            
     def list_directories(self, parent_directory=None):
         """List all directories under a parent directory"""
         try:
@@ -391,31 +606,54 @@ class AzureFileStorageManager:
     def delete_directory(self, directory_path):
         """Delete a directory and all its contents"""
         try:
-            # List all files and subdirectories
-            items = self.file_service.list_directories_and_files(
-                self.share_name,
-                directory_path
-            )
+            # File deletes are issued concurrently; the tree walk stays on this thread
+            with ThreadPoolExecutor(max_workers=get_max_concurrency()) as executor:
+                self._delete_directory_tree(directory_path, executor)
             
-            # Delete all files
-            for item in items:
-                if not item.is_directory:
-                    self.file_service.delete_file(
-                        self.share_name,
-                        directory_path,
-                        item.name
-                    )
-                else:
-                    # Recursively delete subdirectories
-                    self.delete_directory(f"{directory_path}/{item.name}")
+            # The caches are shared with other managers, so prune them in place
+            prefix = f"{directory_path}/"
+            def is_deleted(path):
+                return path == directory_path or path.startswith(prefix)
             
-            # Delete the directory itself
-            self.file_service.delete_directory(
-                self.share_name,
-                directory_path
+            self._verified_dirs.difference_update([path for path in list(self._verified_dirs) if is_deleted(path)])
+            for key in [key for key in list(self._json_cache) if is_deleted(key[1])]:
+                self._json_cache.pop(key, None)
+            self._verified_files.difference_update([key for key in list(self._verified_files) if is_deleted(key[0])])
+            self._provisioned_guids.difference_update(
+                [guid for guid in list(self._provisioned_guids) if is_deleted(f"memory/{guid}")]
             )
             
             return True
         except Exception as e:
             logging.error(f"Error deleting directory {directory_path}: {str(e)}")
-            return False
\ No newline at end of file
+            return False
+
+    def _delete_directory_tree(self, directory_path, executor):
+        # List all files and subdirectories
+        items = self.file_service.list_directories_and_files(
+            self.share_name,
+            directory_path
+        )
+        
+        # Queue all file deletes, recursing into subdirectories meanwhile
+        pending = []
+        for item in items:
+            if not item.is_directory:
+                pending.append(executor.submit(
+                    self.file_service.delete_file,
+                    self.share_name,
+                    directory_path,
+                    item.name
+                ))
+            else:
+                self._delete_directory_tree(f"{directory_path}/{item.name}", executor)
+        
+        # Surface the first failure before removing the (then non-empty) directory
+        for future in pending:
+            future.result()
+        
+        # Delete the directory itself
+        self.file_service.delete_directory(
+            self.share_name,
+            directory_path
+        )